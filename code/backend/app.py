@@ -1,7 +1,10 @@
 from flask import Flask, jsonify, render_template, request, redirect, url_for
 from flask_cors import CORS
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import deque
+import tempfile
+import threading
 import uuid
 import yfinance as yf
 import json
@@ -9,11 +12,15 @@ import os
 from functools import wraps
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
+from performance import realized_performance
+from market_hours import market_state, ticker_market_state, last_close, REGULAR, ALWAYS_OPEN, CLOSED
+from profiling import install_profiler
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+install_profiler(app)
 
 # Data files are stored in the data/ directory at the project root
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -25,6 +32,19 @@ CLOSED_TRADES_FILE = os.path.join(DATA_DIR, "closed-trades.json")
 ALLOWED_EMAILS = os.environ.get("ALLOWED_EMAILS", "").split(",")
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 
+# How many row changes /api/pl remembers for ?since= delta responses.
+# Clients older than this window get a full snapshot instead.
+PL_CHANGELOG_SIZE = int(os.environ.get("PL_CHANGELOG_SIZE", "1000"))
+
+# Maximum quote age in seconds during the regular session and pre/post-market.
+# While the market is closed the last close is served from cache, once it was
+# fetched at least QUOTE_CLOSE_GRACE seconds after the closing bell. Failed
+# fetches are retried after QUOTE_TTL_FAILURE seconds in every session.
+QUOTE_TTL_REGULAR = int(os.environ.get("QUOTE_TTL_REGULAR", "15"))
+QUOTE_TTL_EXTENDED = int(os.environ.get("QUOTE_TTL_EXTENDED", "300"))
+QUOTE_TTL_FAILURE = int(os.environ.get("QUOTE_TTL_FAILURE", str(QUOTE_TTL_EXTENDED)))
+QUOTE_CLOSE_GRACE = int(os.environ.get("QUOTE_CLOSE_GRACE", "900"))
+
 def verify_token(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -56,20 +76,139 @@ def load_trades():
     with open(TRADES_FILE, "r") as f:
         return json.load(f)
 
+# Serializes load -> modify -> save of the trade files within this process.
+# Never hold it across a quote fetch; fetch first, then re-check under the lock.
+_book_lock = threading.Lock()
+
+# Permissions for newly created data files, as open() would give them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def holds_book_lock(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with _book_lock:
+            return f(*args, **kwargs)
+    return decorated_function
+
+def write_json_temp(path, data) -> str:
+    """Write `data` to a unique, fsynced temp file next to `path` and return its path."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        # mkstemp creates the file 0600; keep the target's mode instead
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+def write_json_atomic(path, data):
+    # Swap in a fully written temp file so readers never see a half-written file.
+    os.replace(write_json_temp(path, data), path)
+
 def save_trades(trades):
-    with open(TRADES_FILE, "w") as f:
-        json.dump(trades, f, indent=2)
+    write_json_atomic(TRADES_FILE, trades)
+
+def save_book(trades, closed):
+    """Write both files to temp files first, then swap them in back to back."""
+    closed_tmp = write_json_temp(CLOSED_TRADES_FILE, closed)
+    try:
+        trades_tmp = write_json_temp(TRADES_FILE, trades)
+    except BaseException:
+        os.remove(closed_tmp)
+        raise
+    os.replace(closed_tmp, CLOSED_TRADES_FILE)
+    os.replace(trades_tmp, TRADES_FILE)
+
+_quote_lock = threading.Lock()
+_quote_cache = {}  # ticker -> (price, fetched_at); price 0.0 caches a failed fetch
+
+def quote_is_fresh(ticker: str, price: float, fetched_at: datetime, now: datetime) -> bool:
+    age = (now - fetched_at).total_seconds()
+    state = ticker_market_state(ticker, now)
+
+    if state == CLOSED:
+        if price == 0:
+            # A failed fetch is never final; one upstream error shouldn't stick until the open
+            return age < QUOTE_TTL_FAILURE
+        # Nothing trades until the next session, so a quote taken once the
+        # closing print has settled is final.
+        return fetched_at >= last_close(now) + timedelta(seconds=QUOTE_CLOSE_GRACE)
+
+    ttl = QUOTE_TTL_REGULAR if state in (REGULAR, ALWAYS_OPEN) else QUOTE_TTL_EXTENDED
+    if price == 0:
+        ttl = min(ttl, QUOTE_TTL_FAILURE)
+    return age < ttl
 
 def get_live_price(ticker: str) -> float:
+    now = datetime.now(timezone.utc)
+    with _quote_lock:
+        cached = _quote_cache.get(ticker)
+    if cached and quote_is_fresh(ticker, cached[0], cached[1], now):
+        return cached[0]
+
+    # Failures are cached too (as 0.0) so a failing ticker is retried on the
+    # QUOTE_TTL_FAILURE schedule rather than on every poll.
     try:
         data = yf.Ticker(ticker).history(period="1d")
         if data.empty:
             print(f"No price data for {ticker}")
-            return 0.0
-        return float(data["Close"].iloc[-1])
+            price = 0.0
+        else:
+            price = float(data["Close"].iloc[-1])
     except Exception as e:
         print(f"Error fetching price for {ticker}: {e}")
-        return 0.0
+        price = 0.0
+
+    with _quote_lock:
+        _quote_cache[ticker] = (price, now)
+    return price
+
+def get_live_prices(tickers) -> dict:
+    """Batched get_live_price: one upstream call covers every ticker with a stale quote."""
+    now = datetime.now(timezone.utc)
+    prices = {}
+    stale = []
+
+    for ticker in set(tickers):
+        with _quote_lock:
+            cached = _quote_cache.get(ticker)
+        if cached and quote_is_fresh(ticker, cached[0], cached[1], now):
+            prices[ticker] = cached[0]
+        else:
+            stale.append(ticker)
+
+    if not stale:
+        return prices
+
+    try:
+        data = yf.download(stale, period="1d", auto_adjust=True, progress=False)
+        closes = data["Close"]
+        if not hasattr(closes, "columns"):
+            closes = closes.to_frame(stale[0])
+    except Exception as e:
+        print(f"Error fetching prices for {stale}: {e}")
+        closes = None
+
+    for ticker in stale:
+        series = closes[ticker].dropna() if closes is not None and ticker in closes else []
+        if len(series) == 0:
+            print(f"No price data for {ticker}")
+            prices[ticker] = 0.0
+        else:
+            prices[ticker] = float(series.iloc[-1])
+        with _quote_lock:
+            _quote_cache[ticker] = (prices[ticker], now)
+
+    return prices
 
 def calculate_pl(trade: dict) -> dict:
     trade_id = trade.get("id") # Get ID
@@ -92,6 +231,7 @@ def calculate_pl(trade: dict) -> dict:
             "unrealized_pl_pct": 0,
             "position_type": position_direction,
             "position_amount": trade.get("position_amount"),
+            "market_state": ticker_market_state(ticker),
             "error": "Failed to fetch price"
         }
 
@@ -111,9 +251,107 @@ def calculate_pl(trade: dict) -> dict:
         "unrealized_pl": round(pl, 2),
         "unrealized_pl_pct": round(pl_pct, 2),
         "position_type": position_direction,
-        "position_amount": trade.get("position_amount")
+        "position_amount": trade.get("position_amount"),
+        "market_state": ticker_market_state(ticker)
     }
 
+# Versioned P/L view. Every poll of /api/pl refreshes the snapshot; rows whose
+# price, P/L or existence changed are stamped with a new version so clients can
+# ask for just the changes with /api/pl?since=<version>. Versions are sent as
+# "<epoch>:<n>"; the epoch is unique to this process, so a version handed out
+# before a restart or by another worker never matches and gets a full snapshot.
+_pl_lock = threading.Lock()
+_pl_state = {
+    "epoch": uuid.uuid4().hex[:12],
+    "version": 0,
+    "floor": 0,  # oldest version the changelog can still answer from
+    "rows": {},  # row key -> latest enriched row
+    "log": deque(),  # (version, row key), oldest first
+    "removed": {},  # row key -> version it was removed at, oldest first
+}
+
+def _format_pl_version(version: int) -> str:
+    return f"{_pl_state['epoch']}:{version}"
+
+def _pl_key(row: dict) -> str:
+    return row.get("id") or row.get("ticker")
+
+def _pl_log_change(version: int, key: str):
+    log = _pl_state["log"]
+    if len(log) >= PL_CHANGELOG_SIZE:
+        _pl_state["floor"] = log.popleft()[0]
+    log.append((version, key))
+
+def current_pl_version() -> int:
+    with _pl_lock:
+        return _pl_state["version"]
+
+def refresh_pl_snapshot(rows: list, loaded_at: int) -> str:
+    """Merge freshly computed rows into the versioned view and return its version.
+
+    `loaded_at` is the view version read before the trades were loaded; rows for
+    trades removed after that point are stale and are dropped.
+    """
+    with _pl_lock:
+        current = _pl_state["rows"]
+        tombstones = _pl_state["removed"]
+        fresh = {}
+        for r in rows:
+            key = _pl_key(r)
+            if tombstones.get(key, -1) <= loaded_at:
+                fresh[key] = r
+        changed = [k for k, r in fresh.items() if current.get(k) != r]
+        removed = [k for k in current if k not in fresh]
+
+        if changed or removed:
+            _pl_state["version"] += 1
+            version = _pl_state["version"]
+            for key in changed + removed:
+                _pl_log_change(version, key)
+            _pl_state["rows"] = fresh
+
+        return _format_pl_version(_pl_state["version"])
+
+def mark_pl_removed(trade_id: str):
+    """Record a trade leaving the book so delta clients drop it before the next poll."""
+    with _pl_lock:
+        # Bump the version even if the row isn't in the view yet, so a poll that
+        # loaded the trade before it was removed can't add it back.
+        _pl_state["rows"].pop(trade_id, None)
+        _pl_state["version"] += 1
+        _pl_log_change(_pl_state["version"], trade_id)
+
+        tombstones = _pl_state["removed"]
+        tombstones.pop(trade_id, None)
+        tombstones[trade_id] = _pl_state["version"]
+        if len(tombstones) > PL_CHANGELOG_SIZE:
+            del tombstones[next(iter(tombstones))]
+
+def pl_changes_since(since_version: str):
+    """Return (version, changed rows, removed keys), or None if `since_version` can't be answered."""
+    epoch, _, number = since_version.partition(":")
+    try:
+        since = int(number)
+    except ValueError:
+        return None
+
+    with _pl_lock:
+        version = _pl_state["version"]
+        if epoch != _pl_state["epoch"] or since < _pl_state["floor"] or since > version:
+            return None
+
+        keys = set()
+        # The log is ordered by version, so walk back only as far as `since`.
+        for v, key in reversed(_pl_state["log"]):
+            if v <= since:
+                break
+            keys.add(key)
+
+        rows = _pl_state["rows"]
+        changed = [rows[k] for k in keys if k in rows]
+        removed = [k for k in keys if k not in rows]
+        return _format_pl_version(version), changed, removed
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -124,6 +362,7 @@ def get_trades():
 
 @app.get("/api/pl")
 def api_pl():
+    loaded_at = current_pl_version()
     trades = load_trades()
     enriched = []
 
@@ -131,16 +370,31 @@ def api_pl():
         try:
             enriched.append(calculate_pl(t))
         except Exception as e:
-            enriched.append({"ticker": t["ticker"], "error": str(e)})
-
-    return jsonify(enriched)
-
-@app.post("/add-trade")
-@verify_token
-def add_trade():
-    data = request.get_json()
-
-    new_trade = {
+            enriched.append({"id": t.get("id"), "ticker": t["ticker"], "error": str(e),
+                             "market_state": ticker_market_state(t["ticker"])})
+
+    version = refresh_pl_snapshot(enriched, loaded_at)
+    state = market_state()
+
+    since = request.args.get("since")
+    if since is None:
+        response = jsonify(enriched)
+        response.headers["X-PL-Version"] = str(version)
+        response.headers["X-Market-State"] = state
+        return response
+
+    delta = pl_changes_since(since)
+    if delta is None:
+        # Client is too far behind or holds a version from another process: send everything.
+        return jsonify({"version": version, "full": True, "rows": enriched, "removed": [],
+                        "market_state": state})
+
+    version, changed, removed = delta
+    return jsonify({"version": version, "full": False, "rows": changed, "removed": removed,
+                    "market_state": state})
+
+def build_trade(data: dict) -> dict:
+    return {
         "id": str(uuid.uuid4()),
         "ticker": data["ticker"].upper().strip(),
         "entry_price": float(data["entry_price"]),
@@ -150,6 +404,22 @@ def add_trade():
         "start_date": datetime.utcnow().isoformat()
     }
 
+def build_closed_trade(trade: dict, close_price: float) -> dict:
+    return {
+        **trade,
+        "closePrice": round(close_price, 2),
+        "closeDate": datetime.utcnow().isoformat(),
+        "closed": True
+    }
+
+@app.post("/add-trade")
+@verify_token
+@holds_book_lock
+def add_trade():
+    data = request.get_json()
+
+    new_trade = build_trade(data)
+
     trades = load_trades()
     trades.append(new_trade)
     save_trades(trades)
@@ -158,6 +428,7 @@ def add_trade():
 
 @app.delete("/api/trades/<trade_id>")
 @verify_token
+@holds_book_lock
 def delete_trade(trade_id):
     trades = load_trades()
     original_count = len(trades)
@@ -167,6 +438,7 @@ def delete_trade(trade_id):
         return jsonify({"error": "Trade not found"}), 404
         
     save_trades(trades)
+    mark_pl_removed(trade_id)
     return jsonify({"status": "success", "deleted": trade_id}), 200
 
 def load_closed_trades():
@@ -176,8 +448,7 @@ def load_closed_trades():
         return json.load(f)
 
 def save_closed_trades(closed):
-    with open(CLOSED_TRADES_FILE, "w") as f:
-        json.dump(closed, f, indent=2)
+    write_json_atomic(CLOSED_TRADES_FILE, closed)
 
 @app.post("/api/close-trade")
 @verify_token
@@ -197,31 +468,131 @@ def close_trade():
     if not target_trade:
         return jsonify({"error": "Trade not found"}), 404
 
-    # Determine Close Price
+    # Determine Close Price (outside the book lock; the quote may be slow)
     if manual_price:
         close_price = float(manual_price)
     else:
         close_price = get_live_price(target_trade["ticker"])
 
-    # Create Closed Trade Record
-    closed_trade = {
-        **target_trade,
-        "closePrice": round(close_price, 2),
-        "closeDate": datetime.utcnow().isoformat(),
-        "closed": True
-    }
+    with _book_lock:
+        # Re-read the book: another request may have closed or deleted it meanwhile
+        trades = load_trades()
+        target_trade = next((t for t in trades if t.get("id") == trade_id), None)
+        if not target_trade:
+            return jsonify({"error": "Trade not found"}), 404
 
-    # Save to Closed History
-    closed_trades = load_closed_trades()
-    closed_trades.append(closed_trade)
-    save_closed_trades(closed_trades)
+        # Create Closed Trade Record
+        closed_trade = build_closed_trade(target_trade, close_price)
 
-    # Remove from Active Trades
-    remaining_trades = [t for t in trades if t.get("id") != trade_id]
-    save_trades(remaining_trades)
+        # Move from Active Trades to Closed History
+        closed_trades = load_closed_trades()
+        closed_trades.append(closed_trade)
+        remaining_trades = [t for t in trades if t.get("id") != trade_id]
+        save_book(remaining_trades, closed_trades)
+        invalidate_realized_performance()
+        mark_pl_removed(trade_id)
 
     return jsonify({"status": "success", "closed": trade_id, "price": close_price}), 200
 
+def apply_batch_operation(op: dict, book: dict, closed_trades: list, prices: dict) -> dict:
+    """Apply one add/close/delete to the in-memory book; raises ValueError/KeyError on bad input."""
+    kind = op.get("op")
+
+    if kind == "add":
+        trade = build_trade(op)
+        book[trade["id"]] = trade
+        return {"added": trade}
+
+    if kind not in ("close", "delete"):
+        raise ValueError(f"Unknown op: {kind}")
+
+    trade_id = op["trade_id"]
+    if not isinstance(trade_id, str):
+        raise ValueError("trade_id must be a string")
+    if trade_id not in book:
+        raise ValueError("Trade not found")
+
+    if kind == "delete":
+        del book[trade_id]
+        return {"deleted": trade_id}
+
+    trade = book[trade_id]
+    if op.get("close_price"):
+        close_price = float(op["close_price"])
+    else:
+        close_price = prices.get(trade["ticker"], 0.0)
+        if close_price == 0:
+            raise ValueError(f"Failed to fetch price for {trade['ticker']}")
+
+    closed_trades.append(build_closed_trade(trade, close_price))
+    del book[trade_id]
+    return {"closed": trade_id, "price": close_price}
+
+def apply_batch(operations: list, prices: dict):
+    """Apply `operations` all-or-nothing. Call with _book_lock held; reloads the book
+    so trade ids are checked against its current state."""
+    trades = load_trades()
+    closed_trades = load_closed_trades()
+    book = {t.get("id"): t for t in trades}
+
+    results = []
+    for index, op in enumerate(operations):
+        result = {"index": index, "op": op.get("op") if isinstance(op, dict) else None}
+        try:
+            if not isinstance(op, dict):
+                raise ValueError("Operation must be an object")
+            result.update(apply_batch_operation(op, book, closed_trades, prices))
+            result["status"] = "success"
+        except KeyError as e:
+            result.update({"status": "error", "error": f"Missing field: {e.args[0]}"})
+        except (TypeError, ValueError, AttributeError) as e:
+            result.update({"status": "error", "error": str(e)})
+        results.append(result)
+
+    # All or nothing: any failed operation leaves both files untouched
+    if any(r["status"] == "error" for r in results):
+        for r in results:
+            if r["status"] == "success":
+                r["status"] = "not_applied"
+        return jsonify({"status": "error", "results": results}), 400
+
+    removed_ids = [tid for tid in (t.get("id") for t in trades) if tid not in book]
+    if any(r["op"] == "close" for r in results):
+        save_book(list(book.values()), closed_trades)
+        invalidate_realized_performance()
+    else:
+        save_trades(list(book.values()))
+    for trade_id in removed_ids:
+        mark_pl_removed(trade_id)
+
+    return jsonify({"status": "success", "results": results}), 200
+
+@app.post("/api/trades/batch")
+@verify_token
+def batch_trades():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    operations = data.get("operations")
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations must be a non-empty list"}), 400
+
+    # Fetch every live close price the batch needs in a single quote call,
+    # before taking the book lock
+    open_tickers = {t.get("id"): t["ticker"] for t in load_trades()}
+    tickers = {
+        open_tickers[op["trade_id"]]
+        for op in operations
+        if isinstance(op, dict) and op.get("op") == "close"
+        and not op.get("close_price") and isinstance(op.get("trade_id"), str)
+        and op["trade_id"] in open_tickers
+    }
+    prices = get_live_prices(tickers) if tickers else {}
+
+    with _book_lock:
+        return apply_batch(operations, prices)
+
 @app.get("/api/closed")
 def get_closed_trades():
     if not os.path.exists(CLOSED_TRADES_FILE):
@@ -230,5 +601,38 @@ def get_closed_trades():
         data = json.load(f)
         return jsonify(data)
 
+# Serialized realized-performance stats, keyed by the closed-trades file's
+# mtime/size so hand edits to the file are picked up too.
+_realized_lock = threading.Lock()
+_realized_cache = {"key": None, "body": None}
+
+def _closed_trades_key():
+    try:
+        st = os.stat(CLOSED_TRADES_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def invalidate_realized_performance():
+    with _realized_lock:
+        _realized_cache["body"] = None
+
+def get_realized_performance_body() -> str:
+    key = _closed_trades_key()
+    with _realized_lock:
+        if _realized_cache["body"] is not None and _realized_cache["key"] == key:
+            return _realized_cache["body"]
+
+    body = json.dumps(realized_performance(load_closed_trades()))
+
+    with _realized_lock:
+        _realized_cache["key"] = key
+        _realized_cache["body"] = body
+    return body
+
+@app.get("/api/closed/performance")
+def get_realized_performance():
+    return app.response_class(get_realized_performance_body(), mimetype="application/json")
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,141 @@
+"""US exchange calendar used to decide how often quotes need refreshing.
+
+All of the ETFs we trade are listed in New York, so a single NYSE calendar
+(regular session 9:30-16:00 ET, extended hours 4:00-20:00 ET) covers the book.
+Crypto pairs quoted by Yahoo as e.g. ``BTC-USD`` trade around the clock.
+"""
+
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+EXCHANGE_TZ = ZoneInfo("America/New_York")
+
+PRE_MARKET_OPEN = time(4, 0)
+REGULAR_OPEN = time(9, 30)
+REGULAR_CLOSE = time(16, 0)
+EARLY_CLOSE = time(13, 0)
+POST_MARKET_CLOSE = time(20, 0)
+
+# Market states reported to clients
+PRE = "pre"
+REGULAR = "regular"
+POST = "post"
+CLOSED = "closed"
+ALWAYS_OPEN = "24h"
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    first = date(year, month, 1)
+    offset = (weekday - first.weekday()) % 7
+    return first + timedelta(days=offset + 7 * (n - 1))
+
+
+def _last_weekday(year: int, month: int, weekday: int) -> date:
+    last = date(year + (month == 12), month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> date:
+    # Anonymous Gregorian computus
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _observed(day: date) -> date:
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+@lru_cache(maxsize=8)
+def holidays(year: int) -> frozenset:
+    """Full-day NYSE closures for `year`."""
+    days = {
+        _nth_weekday(year, 1, 0, 3),   # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),   # Washington's Birthday
+        _easter(year) - timedelta(days=2),  # Good Friday
+        _last_weekday(year, 5, 0),     # Memorial Day
+        _observed(date(year, 7, 4)),   # Independence Day
+        _nth_weekday(year, 9, 0, 1),   # Labor Day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        _observed(date(year, 12, 25)), # Christmas
+    }
+    # New Year's Day falling on a Saturday is not observed on the Friday before
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(_observed(new_year))
+    if year >= 2022:
+        days.add(_observed(date(year, 6, 19)))  # Juneteenth
+    return frozenset(days)
+
+
+@lru_cache(maxsize=8)
+def early_closes(year: int) -> frozenset:
+    """Sessions that end at 13:00 ET."""
+    candidates = [
+        date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + timedelta(days=1),  # Day after Thanksgiving
+        date(year, 12, 24),
+    ]
+    return frozenset(d for d in candidates if is_trading_day(d))
+
+
+def is_trading_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in holidays(day.year)
+
+
+def _session_close(day: date) -> time:
+    return EARLY_CLOSE if day in early_closes(day.year) else REGULAR_CLOSE
+
+
+def _local(now: datetime = None) -> datetime:
+    now = now or datetime.now(timezone.utc)
+    return now.astimezone(EXCHANGE_TZ)
+
+
+def market_state(now: datetime = None) -> str:
+    """Return the NYSE session state (pre/regular/post/closed) at `now`."""
+    local = _local(now)
+    day = local.date()
+    if not is_trading_day(day):
+        return CLOSED
+
+    t = local.time()
+    if REGULAR_OPEN <= t < _session_close(day):
+        return REGULAR
+    if PRE_MARKET_OPEN <= t < REGULAR_OPEN:
+        return PRE
+    if _session_close(day) <= t < POST_MARKET_CLOSE:
+        return POST
+    return CLOSED
+
+
+def last_close(now: datetime = None) -> datetime:
+    """Return the end of the most recent regular session at or before `now`."""
+    local = _local(now)
+    day = local.date()
+    while True:
+        if is_trading_day(day):
+            close = datetime.combine(day, _session_close(day), tzinfo=EXCHANGE_TZ)
+            if close <= local:
+                return close
+        day -= timedelta(days=1)
+
+
+def ticker_market_state(ticker: str, now: datetime = None) -> str:
+    """Market state that applies to `ticker`'s listing."""
+    if ticker.upper().endswith("-USD"):
+        return ALWAYS_OPEN
+    return market_state(now)
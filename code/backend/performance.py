@@ -0,0 +1,126 @@
+"""Realized-performance statistics over the closed trade history.
+
+Closed trades are turned into columnar numpy arrays once and every statistic
+is computed over whole columns, so the cost stays flat as the history grows.
+P/L follows the same convention as ``calculate_pl`` in app.py: UW/SHORT
+positions profit when the price falls. Trades without a positive entry and
+close price (``close_trade`` stores 0 when the price fetch failed) are left out
+of every statistic and counted in ``skipped_count``.
+"""
+
+from datetime import datetime, timezone
+import numpy as np
+
+# Holding-period histogram bucket edges, in days
+HOLDING_BUCKETS = [0, 1, 7, 30, 90, np.inf]
+HOLDING_LABELS = ["<1d", "1-7d", "7-30d", "30-90d", "90d+"]
+
+
+def _parse_date(value) -> np.datetime64:
+    if not value:
+        return np.datetime64("NaT", "s")
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return np.datetime64("NaT", "s")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(parsed, "s")
+
+
+def to_columns(closed_trades: list) -> dict:
+    """Split closed trade records into one array per field."""
+    return {
+        "id": np.array([t.get("id") for t in closed_trades], dtype=object),
+        "ticker": np.array([t.get("ticker", "") for t in closed_trades], dtype=object),
+        "direction": np.array([t.get("position_type", "") for t in closed_trades], dtype=object),
+        "entry": np.array([float(t.get("entry_price") or 0) for t in closed_trades], dtype=float),
+        "close": np.array([float(t.get("closePrice") or 0) for t in closed_trades], dtype=float),
+        "shares": np.array([float(t.get("shares") or 0) for t in closed_trades], dtype=float),
+        "start": np.array([_parse_date(t.get("start_date")) for t in closed_trades], dtype="datetime64[s]"),
+        "end": np.array([_parse_date(t.get("closeDate")) for t in closed_trades], dtype="datetime64[s]"),
+    }
+
+
+def _group_sum(keys: np.ndarray, values: np.ndarray) -> dict:
+    if keys.size == 0:
+        return {}
+    labels, inverse = np.unique(keys.astype(str), return_inverse=True)
+    totals = np.bincount(inverse, weights=values)
+    counts = np.bincount(inverse)
+    return {
+        str(label): {"count": int(count), "realized_pl": round(float(total), 2)}
+        for label, total, count in zip(labels, totals, counts)
+    }
+
+
+def _holding_distribution(days: np.ndarray) -> dict:
+    counts, _ = np.histogram(days, bins=HOLDING_BUCKETS)
+    buckets = {label: int(c) for label, c in zip(HOLDING_LABELS, counts)}
+    if days.size == 0:
+        return {"count": 0, "mean": 0, "min": 0, "p25": 0, "median": 0, "p75": 0, "max": 0,
+                "buckets": buckets}
+
+    p25, median, p75 = np.percentile(days, [25, 50, 75])
+    return {
+        "count": int(days.size),
+        "mean": round(float(days.mean()), 2),
+        "min": round(float(days.min()), 2),
+        "p25": round(float(p25), 2),
+        "median": round(float(median), 2),
+        "p75": round(float(p75), 2),
+        "max": round(float(days.max()), 2),
+        "buckets": buckets,
+    }
+
+
+def realized_performance(closed_trades: list) -> dict:
+    """Compute win rate, win/loss averages, holding periods, breakdowns and drawdown."""
+    cols = to_columns(closed_trades)
+    priced = (cols["entry"] > 0) & (cols["close"] > 0)
+    skipped = int((~priced).sum())
+    cols = {name: values[priced] for name, values in cols.items()}
+
+    short = np.isin(cols["direction"], ["UW", "SHORT"])
+    sign = np.where(short, -1.0, 1.0)
+    pl = (cols["close"] - cols["entry"]) * cols["shares"] * sign
+
+    wins = pl[pl > 0]
+    losses = pl[pl < 0]
+    count = pl.size
+
+    held = ~(np.isnat(cols["start"]) | np.isnat(cols["end"]))
+    days = (cols["end"][held] - cols["start"][held]) / np.timedelta64(1, "D")
+
+    # Cumulative curve in close order; trades with no close date sort last.
+    order = np.argsort(cols["end"], kind="stable")
+    cumulative = np.cumsum(pl[order])
+    peaks = np.maximum.accumulate(np.concatenate(([0.0], cumulative)))[1:]
+    drawdown = peaks - cumulative
+
+    curve = [
+        {
+            "id": cols["id"][i],
+            "ticker": cols["ticker"][i],
+            "close_date": None if np.isnat(cols["end"][i]) else str(cols["end"][i]),
+            "realized_pl": round(float(pl[i]), 2),
+            "cumulative_pl": round(float(cum), 2),
+        }
+        for i, cum in zip(order.tolist(), cumulative.tolist())
+    ]
+
+    return {
+        "trade_count": int(count),
+        "skipped_count": skipped,
+        "win_count": int(wins.size),
+        "loss_count": int(losses.size),
+        "win_rate": round(float(wins.size / count), 4) if count else 0,
+        "total_realized_pl": round(float(pl.sum()), 2),
+        "average_win": round(float(wins.mean()), 2) if wins.size else 0,
+        "average_loss": round(float(losses.mean()), 2) if losses.size else 0,
+        "holding_period_days": _holding_distribution(days),
+        "by_ticker": _group_sum(cols["ticker"], pl),
+        "by_direction": _group_sum(cols["direction"], pl),
+        "cumulative_pl": curve,
+        "max_drawdown": round(float(drawdown.max()), 2) if count else 0,
+    }
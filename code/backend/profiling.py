@@ -0,0 +1,219 @@
+"""Opt-in per-request profiling for the Flask app.
+
+Nothing is hooked into the app unless one of these is set:
+
+- ``PROFILE_ENABLED=1``: profile every request
+- ``PROFILE_SAMPLE_RATE=0.05``: profile a random fraction of requests
+- ``PROFILE_TOKEN=<secret>``: profile requests sent with ``X-Profile: <secret>``
+
+``PROFILE_MODE`` picks the profiler. ``sample`` (default) polls the request
+thread's stack every ``PROFILE_INTERVAL_MS`` and writes collapsed stacks
+(``.folded``) that flamegraph.pl, inferno and speedscope read directly.
+``cprofile`` writes a pstats dump (``.prof``) for snakeviz/flameprof.
+Output goes to ``PROFILE_DIR``, keeping the newest ``PROFILE_KEEP`` files, and
+a top-``PROFILE_TOP_N`` summary is printed for each profiled request.
+
+Settings are read when ``install_profiler`` runs, so values from ``.env`` apply.
+Profiler errors are logged and never fail the request being profiled.
+"""
+
+from collections import Counter
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+# Filled in by install_profiler
+_settings = {}
+
+# Only one cProfile can be active per process on Python 3.12+
+_cprofile_lock = threading.Lock()
+
+# Names of the files this module writes; rotation never touches anything else
+_PROFILE_NAME = re.compile(r"^\d{8}-\d{6}-[0-9a-f]{6}-.+\.(prof|folded)$")
+
+
+def _load_settings() -> dict:
+    env = os.environ
+    return {
+        "enabled": env.get("PROFILE_ENABLED", "").lower() in ("1", "true", "yes"),
+        "sample_rate": float(env.get("PROFILE_SAMPLE_RATE", "0")),
+        "token": env.get("PROFILE_TOKEN", ""),
+        "mode": env.get("PROFILE_MODE", "sample"),
+        "dir": env.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "coins-profiles")),
+        "keep": int(env.get("PROFILE_KEEP", "50")),
+        "top_n": int(env.get("PROFILE_TOP_N", "10")),
+        "interval": float(env.get("PROFILE_INTERVAL_MS", "5")) / 1000,
+    }
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's call stack on a background thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+    def summary(self, top_n: int) -> str:
+        total = sum(self.stacks.values())
+        if not total:
+            return "  (no samples)"
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return "\n".join(
+            f"  {count / total:6.1%}  {label}" for label, count in leaves.most_common(top_n)
+        )
+
+
+class CProfileRecorder:
+    """Deterministic cProfile run of the request."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path: str):
+        self.profile.dump_stats(path)
+
+    def summary(self, top_n: int) -> str:
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(top_n)
+        return out.getvalue().rstrip()
+
+
+def _should_profile() -> bool:
+    if _settings["enabled"]:
+        return True
+    token = _settings["token"]
+    if token:
+        header = request.headers.get("X-Profile")
+        if header and hmac.compare_digest(header, token):
+            return True
+    rate = _settings["sample_rate"]
+    return rate > 0 and random.random() < rate
+
+
+def _rotate(directory: str, keep: int):
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if _PROFILE_NAME.match(name)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _start_profile():
+    locked = False
+    try:
+        if not _should_profile():
+            return
+        if _settings["mode"] == "cprofile":
+            # Another request is already under cProfile; let this one run unprofiled
+            locked = _cprofile_lock.acquire(blocking=False)
+            if not locked:
+                return
+            profiler = CProfileRecorder()
+        else:
+            profiler = StackSampler(threading.get_ident(), _settings["interval"])
+        profiler.start()
+        g._profile_started = time.perf_counter()
+        g._profiler = profiler
+    except Exception as e:
+        print(f"Failed to start profiler: {e}")
+        if locked:
+            _cprofile_lock.release()
+
+
+def _release(profiler):
+    if isinstance(profiler, CProfileRecorder):
+        _cprofile_lock.release()
+
+
+def _finish_profile(exc):
+    profiler = g.pop("_profiler", None)
+    if profiler is None:
+        return
+    try:
+        profiler.stop()
+    except Exception as e:
+        print(f"Failed to stop profiler: {e}")
+        return
+    finally:
+        _release(profiler)
+    elapsed_ms = (time.perf_counter() - g.pop("_profile_started")) * 1000
+
+    try:
+        os.makedirs(_settings["dir"], exist_ok=True)
+        slug = request.path.strip("/").replace("/", "_") or "index"
+        ext = "prof" if isinstance(profiler, CProfileRecorder) else "folded"
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}-"
+                f"{request.method}-{slug}-{int(elapsed_ms)}ms.{ext}")
+        path = os.path.join(_settings["dir"], name)
+        profiler.write(path)
+        _rotate(_settings["dir"], _settings["keep"])
+    except Exception as e:
+        print(f"Failed to write profile: {e}")
+        path = None
+
+    try:
+        print(f"Profiled {request.method} {request.path} in {elapsed_ms:.1f}ms -> {path}")
+        print(profiler.summary(_settings["top_n"]))
+    except Exception as e:
+        print(f"Failed to summarize profile: {e}")
+
+
+def install_profiler(app):
+    """Register the profiling hooks on `app` if any trigger is configured."""
+    _settings.update(_load_settings())
+    if not (_settings["enabled"] or _settings["sample_rate"] > 0 or _settings["token"]):
+        return
+    app.before_request(_start_profile)
+    app.teardown_request(_finish_profile)
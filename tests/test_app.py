@@ -16,6 +16,22 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'code', 'backend'))
 
 from app import app, calculate_pl, get_live_price, load_trades, save_trades
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+import app as app_module
+import market_hours
+import performance
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def reset_backend_state():
+    """Clear module-level caches so quotes and P/L versions don't leak between tests."""
+    app_module._quote_cache.clear()
+    app_module._pl_state.update({"version": 0, "floor": 0, "rows": {}, "log": deque(), "removed": {}})
+    app_module.invalidate_realized_performance()
+    yield
+    app_module._quote_cache.clear()
 
 
 @pytest.fixture
@@ -54,6 +70,32 @@ def sample_trades_list(sample_trade):
     return [sample_trade]
 
 
+AUTH_HEADERS = {"Authorization": "Bearer test-token"}
+
+
+@pytest.fixture
+def book(temp_data_dir, sample_trade):
+    """Point the app at temp trade files and bypass Google token checks."""
+    trades_file = os.path.join(temp_data_dir, "trades.json")
+    closed_file = os.path.join(temp_data_dir, "closed-trades.json")
+    other = dict(sample_trade, id="test-id-456", ticker="USO")
+    with open(trades_file, "w") as f:
+        json.dump([sample_trade, other], f)
+    with open(closed_file, "w") as f:
+        json.dump([], f)
+
+    with patch('app.TRADES_FILE', trades_file), \
+            patch('app.CLOSED_TRADES_FILE', closed_file), \
+            patch('app.ALLOWED_EMAILS', ["member@example.com"]), \
+            patch('app.id_token.verify_oauth2_token', return_value={"email": "member@example.com"}):
+        yield trades_file, closed_file
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
 class TestGetLivePrice:
     """Tests for the get_live_price function."""
     
@@ -398,6 +440,555 @@ class TestAddTradePage:
         assert response.status_code == 200
 
 
+class TestAPIPLDelta:
+    """Tests for versioned /api/pl?since= delta responses."""
+
+    TRADES = [
+        {"id": "t-iau", "ticker": "IAU", "entry_price": 90.0, "shares": 10.0,
+         "position_type": "OW", "position_amount": 5.0},
+        {"id": "t-slv", "ticker": "SLV", "entry_price": 60.0, "shares": 10.0,
+         "position_type": "OW", "position_amount": 5.0},
+    ]
+
+    @patch('app.get_live_price')
+    @patch('app.load_trades')
+    def test_since_returns_only_changed_rows(self, mock_load, mock_price, client):
+        """Test that a delta only contains rows whose price moved."""
+        mock_load.return_value = self.TRADES
+        prices = {"IAU": 95.0, "SLV": 65.0}
+        mock_price.side_effect = lambda ticker: prices[ticker]
+
+        response = client.get('/api/pl')
+        version = response.headers["X-PL-Version"]
+        assert len(json.loads(response.data)) == 2
+
+        prices["SLV"] = 66.0
+        data = json.loads(client.get(f'/api/pl?since={version}').data)
+
+        assert data["full"] is False
+        assert [row["id"] for row in data["rows"]] == ["t-slv"]
+        assert data["removed"] == []
+        assert data["version"] != version
+
+    @patch('app.get_live_price')
+    @patch('app.load_trades')
+    def test_since_unchanged_is_empty(self, mock_load, mock_price, client):
+        """Test that polling with the current version returns no rows."""
+        mock_load.return_value = self.TRADES
+        mock_price.return_value = 70.0
+
+        version = client.get('/api/pl').headers["X-PL-Version"]
+        data = json.loads(client.get(f'/api/pl?since={version}').data)
+
+        assert data["full"] is False
+        assert data["rows"] == []
+        assert data["version"] == version
+
+    @staticmethod
+    def _removed_after(client, action):
+        """Poll, run `action`, and return the delta since the first poll."""
+        version = client.get('/api/pl').headers["X-PL-Version"]
+        response = action()
+        assert response.status_code == 200
+        return json.loads(client.get(f'/api/pl?since={version}').data)
+
+    @patch('app.get_live_price', return_value=27.0)
+    def test_delete_endpoint_reported_as_removed(self, mock_price, client, book):
+        """Test that DELETE /api/trades/<id> shows up in `removed`."""
+        data = self._removed_after(
+            client, lambda: client.delete('/api/trades/test-id-123', headers=AUTH_HEADERS))
+
+        assert data["full"] is False
+        assert data["rows"] == []
+        assert data["removed"] == ["test-id-123"]
+
+    @patch('app.get_live_price', return_value=27.0)
+    def test_close_endpoint_reported_as_removed(self, mock_price, client, book):
+        """Test that POST /api/close-trade shows up in `removed`."""
+        data = self._removed_after(
+            client, lambda: client.post('/api/close-trade', json={"trade_id": "test-id-456"},
+                                        headers=AUTH_HEADERS))
+
+        assert data["rows"] == []
+        assert data["removed"] == ["test-id-456"]
+
+    @patch('app.get_live_prices', return_value={"SLV": 27.0})
+    @patch('app.get_live_price', return_value=27.0)
+    def test_batch_removals_reported(self, mock_price, mock_prices, client, book):
+        """Test that batch close and delete both show up in `removed`."""
+        operations = [{"op": "close", "trade_id": "test-id-123"},
+                      {"op": "delete", "trade_id": "test-id-456"}]
+        data = self._removed_after(
+            client, lambda: client.post('/api/trades/batch', json={"operations": operations},
+                                        headers=AUTH_HEADERS))
+
+        assert data["rows"] == []
+        assert sorted(data["removed"]) == ["test-id-123", "test-id-456"]
+
+    @patch('app.load_trades')
+    def test_poll_in_flight_does_not_restore_removed_trade(self, mock_load, client):
+        """Test that a poll which loaded a trade before it was removed doesn't add it back."""
+        mock_load.return_value = self.TRADES
+
+        def delete_mid_poll(ticker):
+            if ticker == "IAU":
+                app_module.mark_pl_removed("t-iau")
+            return 70.0
+
+        with patch('app.get_live_price', return_value=70.0):
+            version = client.get('/api/pl').headers["X-PL-Version"]
+        with patch('app.get_live_price', side_effect=delete_mid_poll):
+            client.get('/api/pl')
+
+        assert "t-iau" not in app_module._pl_state["rows"]
+        delta = app_module.pl_changes_since(version)
+        assert [row["id"] for row in delta[1]] == []
+        assert delta[2] == ["t-iau"]
+
+    @patch('app.get_live_price')
+    @patch('app.load_trades')
+    def test_version_from_other_process_gets_full_snapshot(self, mock_load, mock_price, client):
+        """Test that a version issued before a restart is not trusted."""
+        mock_load.return_value = self.TRADES
+        mock_price.return_value = 70.0
+
+        client.get('/api/pl')
+        for since in ("otherepoch:1", "1", "garbage"):
+            data = json.loads(client.get(f'/api/pl?since={since}').data)
+            assert data["full"] is True
+            assert len(data["rows"]) == 2
+
+    @patch('app.PL_CHANGELOG_SIZE', 1)
+    @patch('app.get_live_price')
+    @patch('app.load_trades')
+    def test_version_older_than_changelog_gets_full_snapshot(self, mock_load, mock_price, client):
+        """Test the fallback when changes have been evicted from the changelog."""
+        mock_load.return_value = self.TRADES
+        prices = {"IAU": 95.0, "SLV": 65.0}
+        mock_price.side_effect = lambda ticker: prices[ticker]
+
+        version = client.get('/api/pl').headers["X-PL-Version"]
+        prices["IAU"] = 96.0
+        client.get('/api/pl')
+        prices["SLV"] = 66.0
+        client.get('/api/pl')
+
+        data = json.loads(client.get(f'/api/pl?since={version}').data)
+        assert data["full"] is True
+        assert len(data["rows"]) == 2
+
+
+class TestMarketHours:
+    """Tests for the NYSE calendar in market_hours.py."""
+
+    @staticmethod
+    def _et(year, month, day, hour, minute=0):
+        return datetime(year, month, day, hour, minute, tzinfo=market_hours.EXCHANGE_TZ)
+
+    def test_holidays_2026(self):
+        """Test rule-based and observed holidays."""
+        holidays = market_hours.holidays(2026)
+        assert date(2026, 4, 3) in holidays     # Good Friday
+        assert date(2026, 7, 3) in holidays     # July 4 on a Saturday, observed Friday
+        assert date(2026, 11, 26) in holidays   # Thanksgiving
+        assert date(2026, 6, 19) in holidays    # Juneteenth
+        assert date(2026, 10, 19) not in holidays
+
+    def test_saturday_new_year_not_observed(self):
+        """Test that New Year's Day on a Saturday closes nothing the Friday before."""
+        assert date(2021, 12, 31) not in market_hours.holidays(2021)
+        assert date(2022, 1, 1) not in market_hours.holidays(2022)
+
+    def test_early_closes(self):
+        """Test sessions that end at 13:00 ET."""
+        early = market_hours.early_closes(2026)
+        assert date(2026, 11, 27) in early
+        assert date(2026, 12, 24) in early
+        assert market_hours.market_state(self._et(2026, 11, 27, 12, 59)) == market_hours.REGULAR
+        assert market_hours.market_state(self._et(2026, 11, 27, 13, 30)) == market_hours.POST
+
+    def test_market_states(self):
+        """Test pre, regular, post and closed sessions on a normal trading day."""
+        assert market_hours.market_state(self._et(2026, 10, 19, 3)) == market_hours.CLOSED
+        assert market_hours.market_state(self._et(2026, 10, 19, 8)) == market_hours.PRE
+        assert market_hours.market_state(self._et(2026, 10, 19, 10)) == market_hours.REGULAR
+        assert market_hours.market_state(self._et(2026, 10, 19, 17)) == market_hours.POST
+        assert market_hours.market_state(self._et(2026, 10, 19, 21)) == market_hours.CLOSED
+        assert market_hours.market_state(self._et(2026, 10, 17, 12)) == market_hours.CLOSED
+
+    def test_last_close_skips_weekend(self):
+        """Test that Monday pre-market points back to Friday's close."""
+        assert market_hours.last_close(self._et(2026, 10, 19, 8)) == self._et(2026, 10, 16, 16)
+
+    def test_crypto_always_open(self):
+        """Test that *-USD tickers ignore the exchange calendar."""
+        saturday = self._et(2026, 10, 17, 12)
+        assert market_hours.ticker_market_state("BTC-USD", saturday) == market_hours.ALWAYS_OPEN
+        assert market_hours.ticker_market_state("IAU", saturday) == market_hours.CLOSED
+
+
+class TestQuoteScheduling:
+    """Tests for market-hours-aware quote caching in get_live_price."""
+
+    @staticmethod
+    def _history(price):
+        mock_data = MagicMock()
+        mock_data.empty = False
+        mock_close_series = MagicMock()
+        mock_close_series.iloc.__getitem__.return_value = price
+        mock_data.__getitem__.return_value = mock_close_series
+        return mock_data
+
+    @patch('app.last_close')
+    @patch('app.ticker_market_state', return_value=market_hours.CLOSED)
+    @patch('app.yf')
+    def test_closed_market_serves_cache(self, mock_yf, mock_state, mock_last_close):
+        """Test that no upstream call is made while closed once the close is cached."""
+        mock_last_close.return_value = datetime.now(timezone.utc) - timedelta(hours=1)
+        mock_yf.Ticker.return_value.history.return_value = self._history(30.0)
+
+        assert get_live_price("SLV") == 30.0
+        assert get_live_price("SLV") == 30.0
+        assert mock_yf.Ticker.call_count == 1
+
+    @patch('app.last_close')
+    @patch('app.ticker_market_state', return_value=market_hours.CLOSED)
+    @patch('app.yf')
+    def test_closed_market_caches_failures(self, mock_yf, mock_state, mock_last_close):
+        """Test that a failing ticker is not retried while the market is closed."""
+        mock_last_close.return_value = datetime.now(timezone.utc) - timedelta(hours=1)
+        mock_yf.Ticker.return_value.history.side_effect = Exception("rate limited")
+
+        for _ in range(5):
+            assert get_live_price("SLV") == 0.0
+        assert mock_yf.Ticker.call_count == 1
+
+    @patch('app.last_close')
+    @patch('app.ticker_market_state', return_value=market_hours.CLOSED)
+    @patch('app.yf')
+    def test_closed_market_cached_failure_expires(self, mock_yf, mock_state, mock_last_close):
+        """Test that a failure cached after the close is retried after QUOTE_TTL_FAILURE."""
+        now = datetime.now(timezone.utc)
+        mock_last_close.return_value = now - timedelta(days=1)
+        mock_yf.Ticker.return_value.history.return_value = self._history(30.0)
+        app_module._quote_cache["SLV"] = (0.0, now - timedelta(seconds=app_module.QUOTE_TTL_FAILURE + 1))
+
+        assert get_live_price("SLV") == 30.0
+        assert mock_yf.Ticker.call_count == 1
+
+    @patch('app.last_close')
+    @patch('app.ticker_market_state', return_value=market_hours.CLOSED)
+    @patch('app.yf')
+    def test_closed_market_refetches_quote_taken_at_the_bell(self, mock_yf, mock_state, mock_last_close):
+        """Test that a quote fetched within QUOTE_CLOSE_GRACE of the close is not final."""
+        close = datetime.now(timezone.utc) - timedelta(hours=1)
+        mock_last_close.return_value = close
+        mock_yf.Ticker.return_value.history.return_value = self._history(31.0)
+        app_module._quote_cache["SLV"] = (30.0, close + timedelta(seconds=1))
+
+        assert get_live_price("SLV") == 31.0
+        assert get_live_price("SLV") == 31.0
+        assert mock_yf.Ticker.call_count == 1
+
+    @patch('app.ticker_market_state', return_value=market_hours.REGULAR)
+    @patch('app.yf')
+    def test_regular_session_refetches_stale_quote(self, mock_yf, mock_state):
+        """Test that a quote older than QUOTE_TTL_REGULAR is refreshed."""
+        mock_yf.Ticker.return_value.history.return_value = self._history(31.0)
+        stale = datetime.now(timezone.utc) - timedelta(seconds=app_module.QUOTE_TTL_REGULAR + 1)
+        app_module._quote_cache["SLV"] = (30.0, stale)
+
+        assert get_live_price("SLV") == 31.0
+        assert mock_yf.Ticker.call_count == 1
+
+    @patch('app.ticker_market_state', return_value=market_hours.PRE)
+    @patch('app.yf')
+    def test_extended_hours_uses_longer_ttl(self, mock_yf, mock_state):
+        """Test that pre-market reuses a quote younger than QUOTE_TTL_EXTENDED."""
+        recent = datetime.now(timezone.utc) - timedelta(seconds=app_module.QUOTE_TTL_REGULAR + 1)
+        app_module._quote_cache["SLV"] = (30.0, recent)
+
+        assert get_live_price("SLV") == 30.0
+        mock_yf.Ticker.assert_not_called()
+
+    @patch('app.get_live_price', return_value=30.0)
+    @patch('app.load_trades')
+    def test_api_pl_reports_market_state(self, mock_load, mock_price, client, sample_trades_list):
+        """Test that rows and headers carry the market state."""
+        mock_load.return_value = sample_trades_list
+
+        response = client.get('/api/pl')
+
+        assert response.headers["X-Market-State"] in (
+            market_hours.PRE, market_hours.REGULAR, market_hours.POST, market_hours.CLOSED)
+        assert "market_state" in json.loads(response.data)[0]
+
+
+class TestRealizedPerformance:
+    """Tests for realized-performance statistics and /api/closed/performance."""
+
+    CLOSED = [
+        {"id": "c1", "ticker": "SLV", "entry_price": 20.0, "closePrice": 25.0, "shares": 10.0,
+         "position_type": "OW", "start_date": "2025-01-01T00:00:00", "closeDate": "2025-01-03T00:00:00"},
+        {"id": "c2", "ticker": "USO", "entry_price": 70.0, "closePrice": 80.0, "shares": 10.0,
+         "position_type": "UW", "start_date": "2025-01-01T00:00:00", "closeDate": "2025-01-11T00:00:00"},
+        {"id": "c3", "ticker": "SLV", "entry_price": 30.0, "closePrice": 33.0, "shares": 10.0,
+         "position_type": "OW", "start_date": "2025-01-10T00:00:00", "closeDate": "2025-01-20T00:00:00"},
+    ]
+
+    def test_statistics(self):
+        """Test win rate, averages, breakdowns and drawdown."""
+        stats = performance.realized_performance(self.CLOSED)
+
+        assert stats["trade_count"] == 3
+        assert stats["win_count"] == 2
+        assert stats["loss_count"] == 1
+        assert stats["win_rate"] == pytest.approx(0.6667)
+        assert stats["average_win"] == 40.0
+        assert stats["average_loss"] == -100.0  # UW loses when the price rises
+        assert stats["by_ticker"]["SLV"] == {"count": 2, "realized_pl": 80.0}
+        assert stats["by_direction"]["UW"] == {"count": 1, "realized_pl": -100.0}
+        assert [p["cumulative_pl"] for p in stats["cumulative_pl"]] == [50.0, -50.0, -20.0]
+        assert stats["max_drawdown"] == 100.0
+        assert stats["holding_period_days"]["median"] == 10.0
+        assert stats["holding_period_days"]["buckets"]["1-7d"] == 1
+
+    def test_skips_unpriced_trades(self):
+        """Test that trades closed without a price are excluded and counted."""
+        unpriced = dict(self.CLOSED[0], id="c4", closePrice=0)
+        stats = performance.realized_performance(self.CLOSED + [unpriced])
+
+        assert stats["trade_count"] == 3
+        assert stats["skipped_count"] == 1
+        assert stats["loss_count"] == 1
+
+    def test_empty_history(self):
+        """Test statistics with no closed trades."""
+        stats = performance.realized_performance([])
+
+        assert stats["trade_count"] == 0
+        assert stats["win_rate"] == 0
+        assert stats["max_drawdown"] == 0
+
+    def test_endpoint_caches_until_invalidated(self, client, temp_data_dir):
+        """Test that the stats are computed once and recomputed after invalidation."""
+        closed_file = os.path.join(temp_data_dir, "closed-trades.json")
+        with open(closed_file, "w") as f:
+            json.dump(self.CLOSED, f)
+
+        with patch('app.CLOSED_TRADES_FILE', closed_file), \
+                patch('app.realized_performance', wraps=performance.realized_performance) as spy:
+            first = client.get('/api/closed/performance')
+            second = client.get('/api/closed/performance')
+            assert spy.call_count == 1
+            assert first.data == second.data
+            assert json.loads(first.data)["trade_count"] == 3
+
+            app_module.invalidate_realized_performance()
+            client.get('/api/closed/performance')
+            assert spy.call_count == 2
+
+
+    # The file-stat cache key is pinned so only close_trade's explicit
+    # invalidation can make the new trade appear.
+    @patch('app._closed_trades_key', return_value=("pinned",))
+    @patch('app.get_live_price', return_value=27.0)
+    def test_close_trade_invalidates_cache(self, mock_price, mock_key, client, book):
+        """Test that a real close shows up in the next performance response."""
+        assert json.loads(client.get('/api/closed/performance').data)["trade_count"] == 0
+
+        response = client.post('/api/close-trade', json={"trade_id": "test-id-123"}, headers=AUTH_HEADERS)
+        assert response.status_code == 200
+
+        stats = json.loads(client.get('/api/closed/performance').data)
+        assert stats["trade_count"] == 1
+        assert [p["id"] for p in stats["cumulative_pl"]] == ["test-id-123"]
+
+    @patch('app._closed_trades_key', return_value=("pinned",))
+    @patch('app.get_live_prices', return_value={"SLV": 27.0, "USO": 30.0})
+    def test_batch_close_invalidates_cache(self, mock_prices, mock_key, client, book):
+        """Test that a batch close shows up in the next performance response."""
+        assert json.loads(client.get('/api/closed/performance').data)["trade_count"] == 0
+
+        operations = [{"op": "close", "trade_id": "test-id-123"},
+                      {"op": "close", "trade_id": "test-id-456"}]
+        response = client.post('/api/trades/batch', json={"operations": operations}, headers=AUTH_HEADERS)
+        assert response.status_code == 200
+
+        stats = json.loads(client.get('/api/closed/performance').data)
+        assert stats["trade_count"] == 2
+        assert sorted(stats["by_ticker"]) == ["SLV", "USO"]
+
+class TestBatchTrades:
+    """Tests for the /api/trades/batch endpoint."""
+
+    @patch('app.get_live_prices', return_value={"SLV": 27.0})
+    def test_batch_success(self, mock_prices, client, book):
+        """Test closing, deleting and adding in one call with one price fetch."""
+        trades_file, closed_file = book
+        operations = [
+            {"op": "close", "trade_id": "test-id-123"},
+            {"op": "delete", "trade_id": "test-id-456"},
+            {"op": "add", "ticker": "gld", "entry_price": 190.0, "shares": 5,
+             "position_type": "OW", "position_amount": 5},
+        ]
+
+        response = client.post('/api/trades/batch', json={"operations": operations}, headers=AUTH_HEADERS)
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert [r["status"] for r in data["results"]] == ["success"] * 3
+        assert data["results"][0]["price"] == 27.0
+        mock_prices.assert_called_once_with({"SLV"})
+        assert [t["ticker"] for t in read_json(trades_file)] == ["GLD"]
+        assert read_json(closed_file)[0]["closePrice"] == 27.0
+        assert [f for f in os.listdir(os.path.dirname(trades_file)) if f.endswith(".tmp")] == []
+
+    @patch('app.get_live_prices', return_value={"SLV": 27.0})
+    def test_batch_is_all_or_nothing(self, mock_prices, client, book):
+        """Test that one failing operation leaves both files untouched."""
+        trades_file, closed_file = book
+        before = read_json(trades_file)
+        operations = [
+            {"op": "close", "trade_id": "test-id-123"},
+            {"op": "delete", "trade_id": "missing"},
+            {"op": "add", "ticker": "GLD"},
+        ]
+
+        response = client.post('/api/trades/batch', json={"operations": operations}, headers=AUTH_HEADERS)
+
+        assert response.status_code == 400
+        results = json.loads(response.data)["results"]
+        assert [r["status"] for r in results] == ["not_applied", "error", "error"]
+        assert results[1]["error"] == "Trade not found"
+        assert results[2]["error"].startswith("Missing field")
+        assert read_json(trades_file) == before
+        assert read_json(closed_file) == []
+
+    @patch('app.get_live_prices', return_value={})
+    def test_batch_rejects_malformed_bodies(self, mock_prices, client, book):
+        """Test that malformed input returns 400 instead of a server error."""
+        response = client.post('/api/trades/batch', json=[{"op": "add"}], headers=AUTH_HEADERS)
+        assert response.status_code == 400
+
+        response = client.post('/api/trades/batch', json={"operations": []}, headers=AUTH_HEADERS)
+        assert response.status_code == 400
+
+        response = client.post('/api/trades/batch', json={"operations": [{"op": "close", "trade_id": ["a"]}]},
+                               headers=AUTH_HEADERS)
+        assert response.status_code == 400
+        assert json.loads(response.data)["results"][0]["error"] == "trade_id must be a string"
+
+    def test_saves_keep_file_mode(self, book):
+        """Test that atomic saves keep the data file's permissions."""
+        trades_file, _ = book
+        os.chmod(trades_file, 0o664)
+
+        app_module.save_trades(read_json(trades_file))
+
+        assert os.stat(trades_file).st_mode & 0o777 == 0o664
+
+    def test_new_file_uses_umask_default(self, temp_data_dir):
+        """Test that a file created by an atomic save gets the usual umask permissions."""
+        path = os.path.join(temp_data_dir, "new.json")
+
+        app_module.write_json_atomic(path, [])
+
+        assert os.stat(path).st_mode & 0o777 == 0o666 & ~app_module._UMASK
+
+    def test_quote_fetch_runs_outside_book_lock(self, client, book):
+        """Test that batch and single closes don't hold the book lock while fetching prices."""
+        def fetch(*args):
+            assert not app_module._book_lock.locked()
+            return {"SLV": 27.0} if isinstance(args[0], set) else 27.0
+
+        with patch('app.get_live_prices', side_effect=fetch), patch('app.get_live_price', side_effect=fetch):
+            response = client.post('/api/trades/batch', json={"operations": [
+                {"op": "close", "trade_id": "test-id-123"}]}, headers=AUTH_HEADERS)
+            assert response.status_code == 200
+            response = client.post('/api/close-trade', json={"trade_id": "test-id-456"},
+                                   headers=AUTH_HEADERS)
+            assert response.status_code == 200
+
+    def test_close_rechecks_trade_after_fetch(self, client, book):
+        """Test that a trade deleted while its price was being fetched is not closed."""
+        trades_file, closed_file = book
+
+        def delete_during_fetch(ticker):
+            app_module.save_trades([t for t in read_json(trades_file) if t["id"] != "test-id-123"])
+            return 27.0
+
+        with patch('app.get_live_price', side_effect=delete_during_fetch):
+            response = client.post('/api/close-trade', json={"trade_id": "test-id-123"},
+                                   headers=AUTH_HEADERS)
+
+        assert response.status_code == 404
+        assert read_json(closed_file) == []
+
+    def test_batch_requires_token(self, client):
+        """Test that the batch endpoint is authenticated."""
+        response = client.post('/api/trades/batch', json={"operations": [{"op": "delete", "trade_id": "x"}]})
+        assert response.status_code == 401
+
+
+class TestProfiling:
+    """Tests for the opt-in request profiling hooks."""
+
+    PROFILE_VARS = ("PROFILE_ENABLED", "PROFILE_SAMPLE_RATE", "PROFILE_TOKEN", "PROFILE_MODE",
+                    "PROFILE_DIR", "PROFILE_KEEP")
+
+    def _app(self, env):
+        from flask import Flask
+        clean = {k: v for k, v in os.environ.items() if k not in self.PROFILE_VARS}
+        with patch.dict(os.environ, {**clean, **env}, clear=True):
+            test_app = Flask("profiling-test")
+            test_app.get("/ping")(lambda: "pong")
+            profiling.install_profiler(test_app)
+        return test_app
+
+    def test_disabled_installs_no_hooks(self):
+        """Test that nothing is registered when profiling is not configured."""
+        test_app = self._app({})
+        assert not test_app.before_request_funcs
+        assert not test_app.teardown_request_funcs
+
+    def test_token_header_triggers_profile(self, temp_data_dir):
+        """Test that only requests with the right X-Profile header are profiled."""
+        test_app = self._app({"PROFILE_TOKEN": "secret", "PROFILE_DIR": temp_data_dir,
+                              "PROFILE_MODE": "cprofile"})
+        client = test_app.test_client()
+
+        assert client.get('/ping', headers={"X-Profile": "wrong"}).status_code == 200
+        assert os.listdir(temp_data_dir) == []
+
+        assert client.get('/ping', headers={"X-Profile": "secret"}).status_code == 200
+        files = os.listdir(temp_data_dir)
+        assert len(files) == 1 and files[0].endswith(".prof")
+
+    def test_rotation_only_removes_own_files(self, temp_data_dir):
+        """Test that PROFILE_KEEP rotation leaves unrelated files alone."""
+        foreign = os.path.join(temp_data_dir, "keep-me.txt")
+        open(foreign, "w").close()
+        test_app = self._app({"PROFILE_ENABLED": "1", "PROFILE_DIR": temp_data_dir, "PROFILE_KEEP": "1"})
+        client = test_app.test_client()
+
+        for _ in range(3):
+            assert client.get('/ping').status_code == 200
+
+        files = sorted(os.listdir(temp_data_dir))
+        assert "keep-me.txt" in files
+        assert len([f for f in files if f.endswith(".folded")]) == 1
+
+    def test_profiler_errors_do_not_fail_request(self, temp_data_dir):
+        """Test that a profiler that can't start still lets the request through."""
+        test_app = self._app({"PROFILE_ENABLED": "1", "PROFILE_DIR": temp_data_dir,
+                              "PROFILE_MODE": "cprofile"})
+
+        with patch.object(profiling.CProfileRecorder, "start", side_effect=ValueError("busy")):
+            assert test_app.test_client().get('/ping').status_code == 200
+        assert not profiling._cprofile_lock.locked()
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
 